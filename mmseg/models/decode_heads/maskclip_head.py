@@ -1,19 +1,70 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import contextlib
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from mmcv.utils import print_log
+from mmcv.utils import digit_version, print_log
 from mmseg.utils import get_root_logger
 from ..builder import HEADS
 from .decode_head import BaseDecodeHead
 
+
+def _load_to_cpu(path):
+    # memory-map the file on the host instead of staging it on the GPU; the
+    # tensors are copied straight into the head's parameters and buffers
+    kwargs = dict(map_location='cpu')
+    if digit_version(torch.__version__) >= digit_version('1.13.0'):
+        kwargs['weights_only'] = True
+    if digit_version(torch.__version__) >= digit_version('2.1.0'):
+        kwargs['mmap'] = True
+    return torch.load(path, **kwargs)
+
+
+def _copy_from_cpu(dst, src):
+    # stage through pinned memory so that uploads to the GPU do not block
+    if dst.is_cuda:
+        src = src.pin_memory()
+    dst.copy_(src, non_blocking=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(fn):
+    return torch.compile(fn)
+
+
+def _suppress_classes(output, pd_thresh):
+    # the temperature must stay: pd_thresh is compared against the
+    # probability itself, which is not invariant to rescaling
+    max_cls_conf = F.softmax(output*100, dim=1).amax(dim=(2, 3))
+    selected_cls = max_cls_conf[:, :, None, None] < pd_thresh
+    return output.masked_fill_(selected_cls, -100)
+
+
+def _smoothing_candidates(output, ks_thresh):
+    # class probabilities and the positions whose own prediction is not
+    # confident enough, which take the key-smoothed scores instead
+    output = F.softmax(output*100, dim=1)
+    return output, output.amax(dim=1, keepdim=True) < ks_thresh
+
+
+def _scaled_dot_product_attention(q, k, v):
+    # fused attention kernel when available (PyTorch >= 2.0)
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v)
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    return attn.softmax(dim=-1) @ v
+
+
 @HEADS.register_module()
 class MaskClipHead(BaseDecodeHead):
 
     def __init__(self, text_categories, text_channels, text_embeddings_path,
                     visual_projs_path, vit=False, ks_thresh=0., pd_thresh=0.,
-                    attn_pooling=False, num_heads=32, **kwargs):
+                    attn_pooling=False, num_heads=32, bf16=False,
+                    compile_refine=False, **kwargs):
         super(MaskClipHead, self).__init__(**kwargs)
 
         self.text_categories = text_categories
@@ -30,18 +81,28 @@ class MaskClipHead(BaseDecodeHead):
         
         self.vit = vit
         if vit:
-            self.proj = nn.Conv2d(self.in_channels, text_channels, 1, bias=False)
+            self.proj = nn.Linear(self.in_channels, text_channels, bias=False)
         else:
-            self.q_proj = nn.Conv2d(self.in_channels, self.in_channels, 1)
-            self.k_proj = nn.Conv2d(self.in_channels, self.in_channels, 1)
-            self.v_proj = nn.Conv2d(self.in_channels, self.in_channels, 1)
-            self.c_proj = nn.Conv2d(self.in_channels, text_channels, 1)
+            self.q_proj = nn.Linear(self.in_channels, self.in_channels)
+            self.k_proj = nn.Linear(self.in_channels, self.in_channels)
+            self.v_proj = nn.Linear(self.in_channels, self.in_channels)
+            self.c_proj = nn.Linear(self.in_channels, text_channels)
+            self._share_qkv_storage()
         self.load_visual_projs()
 
         self.ks_thresh = ks_thresh
         self.pd_thresh = pd_thresh
         self.attn_pooling = attn_pooling
         self.num_heads = num_heads
+        if bf16 and not hasattr(torch, 'autocast'):
+            raise RuntimeError('bf16 inference requires torch.autocast '
+                               '(PyTorch >= 1.10)')
+        self.bf16 = bf16
+        if compile_refine and not hasattr(torch, 'compile'):
+            raise RuntimeError('compile_refine requires torch.compile '
+                               '(PyTorch >= 2.0)')
+        self.compile_refine = compile_refine
+        self._needs_refine = (pd_thresh > 0) or (ks_thresh > 0)
 
     def init_weights(self):
         super(MaskClipHead, self).init_weights()
@@ -52,105 +113,180 @@ class MaskClipHead(BaseDecodeHead):
         self.load_visual_projs()
 
     def load_text_embeddings(self):
-        loaded = torch.load(self.text_embeddings_path, map_location='cuda')
-        self.text_embeddings[:, :] = loaded[:, :]
+        loaded = _load_to_cpu(self.text_embeddings_path)
+        _copy_from_cpu(self.text_embeddings, loaded)
+        self._cache_text_embeddings()
         print_log(f'Loaded text embeddings from {self.text_embeddings_path}', logger=get_root_logger())
 
+    def _cache_text_embeddings(self):
+        # text embeddings loaded from file are frozen, so normalize them once
+        # instead of on every forward
+        text_embeddings = F.normalize(self.text_embeddings.detach(), dim=1)
+        self.register_buffer(
+            'text_embeddings_normed', text_embeddings.contiguous(),
+            persistent=False)
+
     def load_visual_projs(self):
-        loaded = torch.load(self.visual_projs_path, map_location='cuda')
+        loaded = _load_to_cpu(self.visual_projs_path)
         attrs = ['proj'] if self.vit else ['q_proj', 'k_proj', 'v_proj', 'c_proj']
+        # check everything before copying, as load_state_dict would
+        params = {attr: dict(getattr(self, attr).named_parameters())
+                  for attr in attrs}
         for attr in attrs:
-            current_attr = getattr(self, attr)
-            state_dict = loaded[attr]
-            for key in state_dict:
-                if 'weight' in key:
-                    state_dict[key] = state_dict[key][:, :, None, None]
-            current_attr.load_state_dict(state_dict)
+            if set(loaded[attr]) != set(params[attr]):
+                raise RuntimeError(
+                    f'Keys of {attr} in {self.visual_projs_path} are '
+                    f'{sorted(loaded[attr])}, expected '
+                    f'{sorted(params[attr])}')
+            for key, value in loaded[attr].items():
+                param = params[attr][key]
+                if value.shape != param.shape:
+                    raise RuntimeError(
+                        f'size mismatch for {attr}.{key}: copying a param '
+                        f'with shape {tuple(value.shape)} from '
+                        f'{self.visual_projs_path}, the shape in current '
+                        f'model is {tuple(param.shape)}')
+        with torch.no_grad():
+            for attr in attrs:
+                for key, value in loaded[attr].items():
+                    _copy_from_cpu(params[attr][key], value)
         print_log(f'Loaded proj weights from {self.visual_projs_path}', logger=get_root_logger())
-    
+
+    def _share_qkv_storage(self):
+        # q/k/v weights and biases are views into one stacked tensor, so
+        # they run as a single GEMM without keeping a second copy; loads
+        # into the parameters write through to the stacked tensor
+        projs = [self.q_proj, self.k_proj, self.v_proj]
+        with torch.no_grad():
+            for key in ['weight', 'bias']:
+                fused = torch.cat([getattr(proj, key) for proj in projs])
+                for proj, view in zip(projs, fused.chunk(3)):
+                    getattr(proj, key).data = view
+                setattr(self, f'_qkv_{key}', fused)
+
+    def _apply(self, *args, **kwargs):
+        # moving or casting the module replaces each parameter separately,
+        # so the q/k/v views are re-pointed into a new stacked tensor
+        module = super(MaskClipHead, self)._apply(*args, **kwargs)
+        if not self.vit:
+            self._share_qkv_storage()
+        return module
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the projections became nn.Linear store
+        # their weights as 1x1 conv kernels; children are loaded from the
+        # same dict after this hook, so squeeze them in place
+        for attr in ['proj', 'q_proj', 'k_proj', 'v_proj', 'c_proj']:
+            key = f'{prefix}{attr}.weight'
+            if key in state_dict and state_dict[key].dim() == 4:
+                state_dict[key] = state_dict[key][:, :, 0, 0]
+        super(MaskClipHead, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+        if not isinstance(self.text_embeddings, nn.Parameter):
+            self._cache_text_embeddings()
+
     def forward(self, inputs):
         x = self._transform_inputs(inputs)
         q, k, v, cls_token = None, None, None, None
-        if self.vit:
-            if isinstance(x, list) and len(x) == 4:
-                x, q, k, v = x
-            if isinstance(x, list) and len(x) == 2:
-                x, cls_token = x
-            if v is not None:
-                feat = self.proj(v)
-            else:
-                feat = self.proj(x)
-            if cls_token is not None:
-                cls_token = self.proj(cls_token[:, :, None, None])[:, :, 0, 0]
+        # the visual projections can run in bfloat16 at inference; the
+        # cosine logits and the refinement below stay in fp32
+        if self.bf16 and not self.training:
+            autocast = torch.autocast(
+                self.text_embeddings.device.type, dtype=torch.bfloat16)
         else:
-            if self.attn_pooling:
-                N, C, H, W = x.shape
-                x = x.view(N, C, -1).permute(2, 0, 1)  # NCHW -> (HW)NC
-                x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)
-                x, _ = F.multi_head_attention_forward(
-                    query=x, key=x, value=x,
-                    embed_dim_to_check=x.shape[-1],
-                    num_heads=self.num_heads,
-                    q_proj_weight=self.q_proj.weight[:, :, 0, 0],
-                    k_proj_weight=self.k_proj.weight[:, :, 0, 0],
-                    v_proj_weight=self.v_proj.weight[:, :, 0, 0],
-                    in_proj_weight=None,
-                    in_proj_bias=torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
-                    bias_k=None,
-                    bias_v=None,
-                    add_zero_attn=False,
-                    dropout_p=0,
-                    out_proj_weight=self.c_proj.weight[:, :, 0, 0],
-                    out_proj_bias=self.c_proj.bias,
-                    use_separate_proj_weight=True,
-                    training=self.training,
-                    need_weights=False
-                )
-                feat = x[1:].permute(1, 2, 0).view(N, -1, H, W)
+            autocast = contextlib.nullcontext()
+        with autocast:
+            if self.vit:
+                if isinstance(x, list) and len(x) == 4:
+                    x, q, k, v = x
+                if isinstance(x, list) and len(x) == 2:
+                    x, cls_token = x
+                feat = v if v is not None else x
+                # 1x1 projection as a GEMM on the NC(HW) view, which needs no
+                # permute of the contiguous NCHW backbone output
+                N, C, H, W = feat.shape
+                feat = self.proj.weight @ feat.reshape(N, C, H * W)
+                feat = feat.view(N, -1, H, W)
+                if cls_token is not None:
+                    cls_token = self.proj(cls_token)
             else:
-                q = self.q_proj(x)
-                k = self.k_proj(x)
-                q = torch.flatten(q, start_dim=2).transpose(-2, -1)
-                k = torch.flatten(k, start_dim=2).transpose(-2, -1)
-                v = self.v_proj(x)
-                feat = self.c_proj(v)
-        output = self.cls_seg(feat)
-        if not self.training:
+                if self.attn_pooling:
+                    N, C, H, W = x.shape
+                    x = x.view(N, C, -1).transpose(1, 2)  # NCHW -> N(HW)C
+                    x = torch.cat([x.mean(dim=1, keepdim=True), x], dim=1)
+                    L = x.shape[1]
+                    qkv = F.linear(x, self._qkv_weight, self._qkv_bias)
+                    qkv = qkv.view(N, L, 3, self.num_heads, -1)
+                    qkv = qkv.permute(2, 0, 3, 1, 4)
+                    x = _scaled_dot_product_attention(*qkv)
+                    x = x.transpose(1, 2).reshape(N, L, C)
+                    x = self.c_proj(x)
+                    feat = x[:, 1:].transpose(1, 2).reshape(N, -1, H, W)
+                else:
+                    # 1x1 projections as GEMMs over N(HW)C, which is also the
+                    # layout refine_output expects for k; q is never used here,
+                    # so k and v come from one GEMM over the stacked weights
+                    N, C, H, W = x.shape
+                    x = x.permute(0, 2, 3, 1).reshape(N, H * W, C)
+                    kv = F.linear(x, self._qkv_weight[C:], self._qkv_bias[C:])
+                    k, v = kv.chunk(2, dim=-1)
+                    feat = self.c_proj(v).transpose(1, 2).reshape(N, -1, H, W)
+        output = self.cls_seg(feat.float())
+        if not self.training and self._needs_refine:
             output = self.refine_output(output, k)
 
         return output
 
     def cls_seg(self, feat):
-        feat = feat / feat.norm(dim=1, keepdim=True)
-        output = F.conv2d(feat, self.text_embeddings[:, :, None, None])
-        
-        return output
+        # a single GEMM against the text embeddings; the feature
+        # norm is divided out of the (K, HW) logits rather than the larger
+        # (C, HW) feature map
+        if isinstance(self.text_embeddings, nn.Parameter):
+            # learnable embeddings are used as they are
+            text_embeddings = self.text_embeddings
+        else:
+            text_embeddings = self.text_embeddings_normed
+        N, C, H, W = feat.shape
+        feat = feat.reshape(N, C, H * W)
+        output = text_embeddings @ feat
+        output.div_(feat.norm(dim=1, keepdim=True))
+
+        return output.view(N, -1, H, W)
 
     def refine_output(self, output, k):
+        suppress_classes = _suppress_classes
+        smoothing_candidates = _smoothing_candidates
+        if self.compile_refine:
+            suppress_classes = _compile(suppress_classes)
+            smoothing_candidates = _compile(smoothing_candidates)
+
         if self.pd_thresh > 0:
-            N, C, H, W = output.shape
-            _output = F.softmax(output*100, dim=1)
-            max_cls_conf = _output.view(N, C, -1).max(dim=-1)[0]
-            selected_cls = (max_cls_conf < self.pd_thresh)[:, :, None, None].expand(N, C, H, W)
-            output[selected_cls] = -100
+            output = suppress_classes(output, self.pd_thresh)
 
         if k is not None and self.ks_thresh > 0:
-            output = F.softmax(output*100, dim=1)
+            output, selected_pos = smoothing_candidates(output, self.ks_thresh)
             N, C, H, W = output.shape
-            output = output.view(N, C, -1).transpose(-2, -1)
+            # scores stay in the NC(HW) layout throughout, so smoothing is
+            # applied as output @ (k @ k^T) with no transposes of output
+            output = output.view(N, C, -1)
+            selected_pos = selected_pos.view(N, 1, -1)
             # softmax
-            # weight = k @ k.transpose(-2, -1)
-            # weight = F.softmax(weight, dim=-1)
+            # weighted_output = F.scaled_dot_product_attention(
+            #     k, k, output.transpose(-2, -1), scale=1.).transpose(-2, -1)
             # L2 distance
-            k = F.normalize(k, p=2)
-            weight = k @ k.transpose(-2, -1)
-
-            selected_pos = (output.max(dim=-1, keepdim=True)[0] < self.ks_thresh)
-            selected_pos = selected_pos.expand(-1, -1, C)
+            # output @ (k @ k^T) is evaluated as (output @ k) @ k^T so that
+            # the (HW)x(HW) weight matrix is never materialized;
+            # F.normalize(k, p=2) scales each channel over the HW positions,
+            # so that scale is applied to the small (C, channels) product
+            # instead of a copy of k
+            k = k.float()
+            k_norm = k.norm(dim=1).clamp_min(1e-12)
 
-            weighted_output = weight @ output
-            output[selected_pos] = weighted_output[selected_pos]
-            output = output.transpose(-2, -1).view(N, C, H, W)
+            weighted_output = torch.bmm(output, k)
+            weighted_output.div_(k_norm.square()[:, None, :])
+            weighted_output = torch.bmm(weighted_output, k.transpose(-2, -1))
+            output = torch.where(selected_pos, weighted_output, output)
+            output = output.view(N, C, H, W)
 
         return output
 
@@ -0,0 +1,302 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import os.path as osp
+import tempfile
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from mmseg.models.decode_heads import MaskClipHead
+
+N, C, TEXT_C, K, H, W = 2, 32, 16, 5, 6, 5
+
+
+def _make_weights(vit):
+    text_embeddings = torch.randn(K, TEXT_C)
+    text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
+    if vit:
+        projs = {'proj': {'weight': torch.randn(TEXT_C, C) * 0.05}}
+    else:
+        projs = {}
+        for name in ['q_proj', 'k_proj', 'v_proj', 'c_proj']:
+            out_channels = TEXT_C if name == 'c_proj' else C
+            projs[name] = {
+                'weight': torch.randn(out_channels, C) * 0.05,
+                'bias': torch.randn(out_channels) * 0.05
+            }
+    return text_embeddings, projs
+
+
+def _build_head(tempdir, text_embeddings, projs, **kwargs):
+    text_embeddings_path = osp.join(tempdir, 'text.pth')
+    visual_projs_path = osp.join(tempdir, 'projs.pth')
+    torch.save(text_embeddings, text_embeddings_path)
+    torch.save(projs, visual_projs_path)
+    return MaskClipHead(
+        text_categories=K,
+        text_channels=TEXT_C,
+        text_embeddings_path=text_embeddings_path,
+        visual_projs_path=visual_projs_path,
+        in_channels=C,
+        channels=0,
+        num_classes=K,
+        num_heads=4,
+        **kwargs).eval()
+
+
+def _reference_forward(x, text_embeddings, projs, vit=False,
+                       attn_pooling=False, num_heads=4, ks_thresh=0.,
+                       pd_thresh=0.):
+    """Straightforward MaskCLIP head with 1x1 convs and dense attention."""
+
+    def conv(x, name):
+        return F.conv2d(x, projs[name]['weight'][:, :, None, None],
+                        projs[name].get('bias'))
+
+    k = None
+    if vit:
+        if isinstance(x, list):
+            x, _, k, v = x
+            x = v
+        feat = conv(x, 'proj')
+    elif attn_pooling:
+        n, c, h, w = x.shape
+        x = x.view(n, c, -1).permute(2, 0, 1)
+        x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)
+        x, _ = F.multi_head_attention_forward(
+            query=x, key=x, value=x,
+            embed_dim_to_check=c,
+            num_heads=num_heads,
+            q_proj_weight=projs['q_proj']['weight'],
+            k_proj_weight=projs['k_proj']['weight'],
+            v_proj_weight=projs['v_proj']['weight'],
+            in_proj_weight=None,
+            in_proj_bias=torch.cat([projs[name]['bias'] for name in
+                                    ['q_proj', 'k_proj', 'v_proj']]),
+            bias_k=None,
+            bias_v=None,
+            add_zero_attn=False,
+            dropout_p=0,
+            out_proj_weight=projs['c_proj']['weight'],
+            out_proj_bias=projs['c_proj']['bias'],
+            use_separate_proj_weight=True,
+            training=False,
+            need_weights=False)
+        feat = x[1:].permute(1, 2, 0).reshape(n, -1, h, w)
+    else:
+        k = conv(x, 'k_proj').flatten(start_dim=2).transpose(-2, -1)
+        feat = conv(conv(x, 'v_proj'), 'c_proj')
+
+    feat = feat / feat.norm(dim=1, keepdim=True)
+    output = F.conv2d(feat, text_embeddings[:, :, None, None])
+
+    n, c, h, w = output.shape
+    if pd_thresh > 0:
+        max_cls_conf = F.softmax(output * 100, dim=1).view(n, c, -1).max(-1)[0]
+        selected_cls = (max_cls_conf < pd_thresh)[:, :, None, None]
+        output[selected_cls.expand(n, c, h, w)] = -100
+    if k is not None and ks_thresh > 0:
+        output = F.softmax(output * 100, dim=1)
+        output = output.view(n, c, -1).transpose(-2, -1)
+        k = F.normalize(k, p=2)
+        weight = k @ k.transpose(-2, -1)
+        selected_pos = output.max(dim=-1, keepdim=True)[0] < ks_thresh
+        selected_pos = selected_pos.expand(-1, -1, c)
+        weighted_output = weight @ output
+        output[selected_pos] = weighted_output[selected_pos]
+        output = output.transpose(-2, -1).reshape(n, c, h, w)
+    return output
+
+
+def _make_inputs(vit):
+    x = torch.randn(N, C, H, W)
+    if vit:
+        k = torch.randn(N, H * W, C)
+        v = torch.randn(N, H, W, C).permute(0, 3, 1, 2).contiguous()
+        return [[x, k, k, v]]
+    return [x]
+
+
+def _check_head(head, text_embeddings, projs, vit, attn_pooling=False,
+                ks_thresh=0., pd_thresh=0.):
+    inputs = _make_inputs(vit)
+    with torch.no_grad():
+        output = head([[t.clone() for t in inputs[0]]] if vit else
+                      [inputs[0].clone()])
+        expected = _reference_forward(
+            inputs[0], text_embeddings, projs, vit=vit,
+            attn_pooling=attn_pooling, ks_thresh=ks_thresh,
+            pd_thresh=pd_thresh)
+    assert output.shape == (N, K, H, W)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_maskclip_head():
+    settings = [
+        dict(vit=True),
+        dict(vit=False, attn_pooling=False),
+        dict(vit=False, attn_pooling=True),
+    ]
+    thresholds = [
+        dict(),
+        dict(pd_thresh=0.3),
+        dict(pd_thresh=0.9999),
+        dict(ks_thresh=0.5),
+        dict(ks_thresh=1.0, pd_thresh=0.3),
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        for setting in settings:
+            torch.manual_seed(0)
+            text_embeddings, projs = _make_weights(setting['vit'])
+            for threshold in thresholds:
+                head = _build_head(tempdir, text_embeddings, projs,
+                                   **setting, **threshold)
+                _check_head(head, text_embeddings, projs, **setting,
+                            **threshold)
+
+    with pytest.raises(RuntimeError):
+        head.forward_train(None, None, None, None)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'compile'), reason='requires torch.compile')
+def test_maskclip_head_compile_refine():
+    with tempfile.TemporaryDirectory() as tempdir:
+        for vit in [True, False]:
+            torch.manual_seed(0)
+            text_embeddings, projs = _make_weights(vit)
+            head = _build_head(
+                tempdir, text_embeddings, projs, vit=vit, ks_thresh=1.0,
+                pd_thresh=0.3, compile_refine=True)
+            _check_head(head, text_embeddings, projs, vit, ks_thresh=1.0,
+                        pd_thresh=0.3)
+
+
+@pytest.mark.skipif(hasattr(torch, 'compile'), reason='has torch.compile')
+def test_maskclip_head_compile_refine_unavailable():
+    with tempfile.TemporaryDirectory() as tempdir:
+        text_embeddings, projs = _make_weights(vit=True)
+        with pytest.raises(RuntimeError, match='torch.compile'):
+            _build_head(tempdir, text_embeddings, projs, vit=True,
+                        compile_refine=True)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'autocast'), reason='requires torch.autocast')
+def test_maskclip_head_bf16():
+    settings = [
+        dict(vit=True),
+        dict(vit=False, attn_pooling=False),
+        dict(vit=False, attn_pooling=True),
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        for setting in settings:
+            torch.manual_seed(0)
+            text_embeddings, projs = _make_weights(setting['vit'])
+            head = _build_head(tempdir, text_embeddings, projs, bf16=True,
+                               **setting)
+            inputs = _make_inputs(setting['vit'])
+            with torch.no_grad():
+                output = head(inputs)
+                expected = _reference_forward(inputs[0], text_embeddings,
+                                              projs, **setting)
+            # the projections run in bf16 but the logits are fp32
+            assert output.dtype == torch.float32
+            assert output.shape == (N, K, H, W)
+            assert torch.allclose(output, expected, atol=2e-2)
+            assert not torch.allclose(output, expected, atol=1e-6)
+
+            # no autocast in train mode
+            head.train()
+            with torch.no_grad():
+                output = head(inputs)
+            assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_maskclip_head_load_state_dict():
+    with tempfile.TemporaryDirectory() as tempdir:
+        for vit in [True, False]:
+            torch.manual_seed(0)
+            text_embeddings, projs = _make_weights(vit)
+            head = _build_head(tempdir, text_embeddings, projs, vit=vit,
+                               ks_thresh=1.0)
+
+            # checkpoints saved from the conv-based head store the
+            # projections as 1x1 kernels
+            # and both the cached text embeddings and the stacked q/k/v
+            # weights must follow the loaded ones
+            new_text_embeddings, new_projs = _make_weights(vit)
+            state_dict = head.state_dict()
+            state_dict['text_embeddings'] = new_text_embeddings
+            for name, proj in new_projs.items():
+                for key, value in proj.items():
+                    if key == 'weight':
+                        value = value[:, :, None, None]
+                    state_dict[f'{name}.{key}'] = value
+            head.load_state_dict(state_dict)
+            _check_head(head, new_text_embeddings, new_projs, vit,
+                        ks_thresh=1.0)
+
+            # a state dict saved from the head round-trips
+            new_head = _build_head(tempdir, text_embeddings, projs, vit=vit,
+                                   ks_thresh=1.0)
+            new_head.load_state_dict(head.state_dict())
+            _check_head(new_head, new_text_embeddings, new_projs, vit,
+                        ks_thresh=1.0)
+
+
+def test_maskclip_head_qkv_storage():
+    with tempfile.TemporaryDirectory() as tempdir:
+        torch.manual_seed(0)
+        text_embeddings, projs = _make_weights(vit=False)
+        head = _build_head(tempdir, text_embeddings, projs, attn_pooling=True)
+        # the q/k/v parameters stay views into the stacked tensor used by
+        # forward after the module is moved or cast
+        for convert in [lambda head: head, lambda head: head.double(),
+                        lambda head: head.float()]:
+            head = convert(head)
+            for key in ['weight', 'bias']:
+                fused = getattr(head, f'_qkv_{key}')
+                assert fused.dtype == head.c_proj.weight.dtype
+                for i, name in enumerate(['q_proj', 'k_proj', 'v_proj']):
+                    param = getattr(getattr(head, name), key)
+                    assert param.data_ptr() == fused[i * C].data_ptr()
+        _check_head(head, text_embeddings, projs, vit=False,
+                    attn_pooling=True)
+
+
+def test_maskclip_head_learnable_text_embeddings():
+    # without a text embeddings file the embeddings come from a checkpoint
+    # and are used without normalization
+    with tempfile.TemporaryDirectory() as tempdir:
+        torch.manual_seed(0)
+        _, projs = _make_weights(vit=False)
+        visual_projs_path = osp.join(tempdir, 'projs.pth')
+        torch.save(projs, visual_projs_path)
+        head = MaskClipHead(
+            text_categories=K,
+            text_channels=TEXT_C,
+            text_embeddings_path=None,
+            visual_projs_path=visual_projs_path,
+            in_channels=C,
+            channels=0,
+            num_classes=K).eval()
+        text_embeddings = torch.randn(K, TEXT_C) * 0.3
+        head.load_state_dict(
+            dict(text_embeddings=text_embeddings), strict=False)
+        _check_head(head, text_embeddings, projs, vit=False)
+
+
+def test_maskclip_head_load_visual_projs():
+    with tempfile.TemporaryDirectory() as tempdir:
+        torch.manual_seed(0)
+        text_embeddings, projs = _make_weights(vit=True)
+        # same number of elements, wrong shape
+        projs['proj']['weight'] = projs['proj']['weight'].reshape(C, TEXT_C)
+        with pytest.raises(RuntimeError, match='size mismatch'):
+            _build_head(tempdir, text_embeddings, projs, vit=True)
+
+        text_embeddings, projs = _make_weights(vit=False)
+        del projs['k_proj']['bias']
+        with pytest.raises(RuntimeError, match='k_proj'):
+            _build_head(tempdir, text_embeddings, projs)